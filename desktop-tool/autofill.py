@@ -1,9 +1,10 @@
-import os
+import multiprocessing
 import sys
 from contextlib import nullcontext
 from typing import Optional, Union
 
 import click
+from colorama import just_fix_windows_console
 from wakepy import keepawake
 
 from src.constants import Browsers, ImageResizeMethods, TargetSites
@@ -12,8 +13,9 @@ from src.pdf_maker import PdfExporter
 from src.processing import ImagePostProcessingConfig
 from src.utils import bold
 
-# https://stackoverflow.com/questions/12492810/python-how-can-i-make-the-ansi-escape-codes-to-work-also-in-windows
-os.system("")  # enables ansi escape characters in terminal
+# enables ansi escape characters in terminal. unlike `os.system("")`, this does not spawn a shell - which matters as
+# this module is re-imported by every worker process on platforms which spawn rather than fork.
+just_fix_windows_console()
 
 
 def prompt_if_no_arguments(prompt: str) -> Union[str, bool]:
@@ -167,4 +169,6 @@ def main(
 
 
 if __name__ == "__main__":
+    # required for process pools to work in the frozen executable
+    multiprocessing.freeze_support()
     main()
@@ -37,6 +37,8 @@ function doGet(e) {
 """
 
 
+import multiprocessing
+import os
 from enum import Enum
 from functools import partial
 
@@ -218,3 +220,6 @@ DPI_HEIGHT_RATIO = 300 / 1110  # TODO: share this between desktop tool and backe
 
 PROJECT_MAX_SIZE = 612  # shared between target sites
 THREADS = 5  # shared between CardImageCollections
+PROCESSES = os.cpu_count() or 1  # for CPU-bound image processing, shared between CardImageCollections
+# process pools are started while download threads are running, and forking a multithreaded process can deadlock
+PROCESS_POOL_CONTEXT = multiprocessing.get_context("spawn")
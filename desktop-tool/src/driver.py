@@ -1,7 +1,7 @@
 import datetime as dt
 import textwrap
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import contextmanager
 from functools import cached_property
 from pathlib import Path
@@ -20,7 +20,15 @@ from selenium.webdriver.remote.webdriver import WebDriver
 from selenium.webdriver.support.expected_conditions import invisibility_of_element
 from selenium.webdriver.support.ui import Select, WebDriverWait
 
-from src.constants import THREADS, Browsers, Cardstocks, States, TargetSites
+from src.constants import (
+    PROCESS_POOL_CONTEXT,
+    PROCESSES,
+    THREADS,
+    Browsers,
+    Cardstocks,
+    States,
+    TargetSites,
+)
 from src.exc import InvalidStateException
 from src.order import CardImage, CardImageCollection, CardOrder
 from src.processing import ImagePostProcessingConfig
@@ -638,12 +646,21 @@ class AutofillDriver:
         post_processing_config: Optional[ImagePostProcessingConfig],
     ) -> None:
         t = time.time()
-        with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        # the post-processing pool is entered first so it outlives the download threads which submit to it
+        with ProcessPoolExecutor(
+            max_workers=PROCESSES, mp_context=PROCESS_POOL_CONTEXT
+        ) as post_processing_pool, ThreadPoolExecutor(max_workers=THREADS) as pool:
             self.order.fronts.download_images(
-                pool=pool, download_bar=self.download_bar, post_processing_config=post_processing_config
+                pool=pool,
+                download_bar=self.download_bar,
+                post_processing_config=post_processing_config,
+                post_processing_pool=post_processing_pool,
             )
             self.order.backs.download_images(
-                pool=pool, download_bar=self.download_bar, post_processing_config=post_processing_config
+                pool=pool,
+                download_bar=self.download_bar,
+                post_processing_config=post_processing_config,
+                post_processing_pool=post_processing_pool,
             )
             if any([skip_setup is True, auto_save_threshold is not None]):
                 self.authenticate()
@@ -1,13 +1,15 @@
 import base64
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Any, Optional
 
 import ratelimit
 import requests
 
 import src.constants as constants
-from src.processing import ImagePostProcessingConfig, post_process_image
+from src.processing import ImagePostProcessingConfig, post_process_and_save_image
 
 # region network IO
 
@@ -125,10 +127,15 @@ def remove_files(file_list: list[str]) -> None:
 
 
 def download_google_drive_file(
-    drive_id: str, file_path: str, post_processing_config: Optional[ImagePostProcessingConfig]
+    drive_id: str,
+    file_path: str,
+    post_processing_config: Optional[ImagePostProcessingConfig],
+    post_processing_pool: Optional[ProcessPoolExecutor] = None,
 ) -> bool:
     """
     Download the Google Drive file identified by `drive_id` to the specified `file_path`.
+    Post-processing is CPU-bound, so if `post_processing_pool` is given, it's run there - outside of this thread and
+    clear of the GIL - while this thread waits on the result. If the pool is broken, it's run in this thread instead.
     Returns whether the request was successful or not.
     """
 
@@ -136,8 +143,15 @@ def download_google_drive_file(
     if response is not None and len(response) > 0:
         file_bytes = base64.b64decode(response)
         if post_processing_config is not None:
-            processed_image = post_process_image(raw_image=file_bytes, config=post_processing_config)
-            processed_image.save(file_path)
+            try:
+                if post_processing_pool is None:
+                    raise BrokenProcessPool("No process pool given")
+                post_processing_pool.submit(
+                    post_process_and_save_image, file_bytes, post_processing_config, file_path
+                ).result()
+            except BrokenProcessPool:
+                # a worker which crashed breaks the whole pool, but the image itself was downloaded successfully
+                post_process_and_save_image(raw_image=file_bytes, config=post_processing_config, file_path=file_path)
         else:
             # Save the bytes directly to disk - avoid reading in pillow in case any quality degradation occurs
             with open(file_path, "wb") as f:
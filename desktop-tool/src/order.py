@@ -1,6 +1,6 @@
 import os
 import sys
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from glob import glob
 from queue import Queue
 from typing import Optional
@@ -130,11 +130,15 @@ class CardImage:
         queue: Queue["CardImage"],
         download_bar: enlighten.Counter,
         post_processing_config: Optional[ImagePostProcessingConfig],
+        post_processing_pool: Optional[ProcessPoolExecutor] = None,
     ) -> None:
         try:
             if not self.file_exists() and not self.errored and self.file_path is not None:
                 self.errored = not download_google_drive_file(
-                    drive_id=self.drive_id, file_path=self.file_path, post_processing_config=post_processing_config
+                    drive_id=self.drive_id,
+                    file_path=self.file_path,
+                    post_processing_config=post_processing_config,
+                    post_processing_pool=post_processing_pool,
                 )
 
             if self.file_exists() and not self.errored:
@@ -221,13 +225,19 @@ class CardImageCollection:
         pool: ThreadPoolExecutor,
         download_bar: enlighten.Counter,
         post_processing_config: Optional[ImagePostProcessingConfig],
+        post_processing_pool: Optional[ProcessPoolExecutor] = None,
     ) -> None:
         """
         Set up the provided ThreadPoolExecutor to download this collection's images, updating the given progress
         bar with each image. Async function.
+        If `post_processing_pool` is given, downloaded images are post-processed in it rather than in the download
+        threads. It must not be shut down before `pool`.
         """
 
-        pool.map(lambda x: x.download_image(self.queue, download_bar, post_processing_config), self.cards)
+        pool.map(
+            lambda x: x.download_image(self.queue, download_bar, post_processing_config, post_processing_pool),
+            self.cards,
+        )
 
     # endregion
 
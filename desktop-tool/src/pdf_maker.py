@@ -1,17 +1,104 @@
-import os, subprocess
-from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import ExitStack
+from pathlib import Path
 from typing import Optional
 
 import attr
 import enlighten
 import InquirerPy
 from fpdf import FPDF
+from fpdf.image_datastructures import RasterImageInfo
+from fpdf.image_parsing import preload_image
+from PIL import Image, ImageChops, ImageCms, ImageStat
 
-from src.constants import THREADS, States
+from src.constants import PROCESS_POOL_CONTEXT, PROCESSES, THREADS, States
 from src.order import CardOrder
 from src.processing import ImagePostProcessingConfig
 from src.utils import bold
 
+PROGRESS_REFRESH_INTERVAL = 0.25  # minimum time in seconds between redraws of the status and progress bars
+
+CARD_WIDTH_MM = 63
+CARD_HEIGHT_MM = 88
+
+# region A3 layout
+# a landscape A3 page contains 3 rows of 6 cards. all measurements are in millimetres.
+# the grid never changes, so card positions and cut lines are calculated once here rather than per card or page.
+
+A3_COLUMNS = 6
+A3_ROWS = 3
+A3_CARDS_PER_PAGE = A3_COLUMNS * A3_ROWS
+A3_LEFT = 20
+A3_TOP = 15
+A3_GAP = 0.5
+A3_LINE_WIDTH = 0.14
+A3_VERTICAL_LINE_LENGTH = 297
+A3_HORIZONTAL_LINE_LENGTH = 440
+
+# card positions in the order cards are placed - left to right, then top to bottom
+A3_POSITIONS: tuple[tuple[float, float], ...] = tuple(
+    (A3_LEFT + column * (CARD_WIDTH_MM + A3_GAP), A3_TOP + row * (CARD_HEIGHT_MM + A3_GAP))
+    for row in range(A3_ROWS)
+    for column in range(A3_COLUMNS)
+)
+
+
+def cut_line_offsets(start: float, card_size: float, count: int) -> tuple[float, ...]:
+    """
+    Offsets of the cut lines along one axis of a grid of `count` cards of `card_size` beginning at `start`.
+    """
+
+    between_cards = [
+        offset
+        for i in range(1, count)
+        for offset in (
+            start + card_size * i + A3_GAP * (i - 1) + 0.1,
+            start + card_size * i + A3_GAP * i - A3_LINE_WIDTH,
+        )
+    ]
+    return (
+        start - A3_LINE_WIDTH,
+        *between_cards,
+        start + card_size * count + A3_GAP * (count - 1) + 0.1,
+    )
+
+
+A3_CUT_LINE_XS = cut_line_offsets(A3_LEFT, CARD_WIDTH_MM, A3_COLUMNS)
+A3_CUT_LINE_YS = cut_line_offsets(A3_TOP, CARD_HEIGHT_MM, A3_ROWS)
+A3_CUT_LINE_DASH = 1
+A3_CUT_LINE_SPACE = 2
+
+
+def a3_cut_lines_stream(pdf: FPDF) -> str:
+    """
+    Builds the PDF content stream which draws every cut line on an A3 page of `pdf`. The cut lines are identical on
+    every page, so they are written as a single dashed path and stroked once rather than as separate lines.
+    The dash pattern is scoped to the stream by saving and restoring the graphics state.
+    """
+
+    k, page_height = pdf.k, pdf.h
+    segments = [(x, 0.0, x, A3_VERTICAL_LINE_LENGTH) for x in A3_CUT_LINE_XS] + [
+        (0.0, y, A3_HORIZONTAL_LINE_LENGTH, y) for y in A3_CUT_LINE_YS
+    ]
+    path = " ".join(
+        f"{x1 * k:.2f} {(page_height - y1) * k:.2f} m {x2 * k:.2f} {(page_height - y2) * k:.2f} l"
+        for x1, y1, x2, y2 in segments
+    )
+    return f"q [{A3_CUT_LINE_DASH * k:.3f} {A3_CUT_LINE_SPACE * k:.3f}] 0 d {path} S Q"
+
+
+# endregion
+
 
 @attr.s
 class PdfExporter:
@@ -22,6 +109,7 @@ class PdfExporter:
     card_height_in_inches: float = attr.ib(default=3.71)
     file_num: int = attr.ib(default=1)
     number_of_cards_per_file: int = attr.ib(default=60)
+    number_of_a3_pages_per_file: int = attr.ib(default=10)
     paths_by_slot: dict[int, tuple[str, str]] = attr.ib(default={})
     save_path: str = attr.ib(default="")
     separate_faces: bool = attr.ib(default=False)
@@ -30,6 +118,11 @@ class PdfExporter:
     status_bar: enlighten.StatusBar = attr.ib(init=False, default=False)
     download_bar: enlighten.Counter = attr.ib(init=False, default=None)
     processed_bar: enlighten.Counter = attr.ib(init=False, default=None)
+    a3_cut_lines: str = attr.ib(init=False, default="")
+    card_image_stream: str = attr.ib(init=False, default="")
+    prepared_paths: dict[str, str] = attr.ib(init=False, default=attr.Factory(dict))
+    preparing: dict[Future[str], str] = attr.ib(init=False, default=attr.Factory(dict))
+    preparing_paths: set[str] = attr.ib(init=False, default=attr.Factory(set))
 
     def configure_bars(self) -> None:
         num_images = len(self.order.fronts.cards) + len(self.order.backs.cards)
@@ -38,17 +131,26 @@ class PdfExporter:
             status_format=status_format,
             state=f"{bold(self.state)}",
             position=1,
+            min_delta=PROGRESS_REFRESH_INTERVAL,
+        )
+        self.download_bar = self.manager.counter(
+            total=num_images, desc="Images Downloaded", position=2, min_delta=PROGRESS_REFRESH_INTERVAL
+        )
+        self.processed_bar = self.manager.counter(
+            total=num_images, desc="Images Processed", position=3, min_delta=PROGRESS_REFRESH_INTERVAL
         )
-        self.download_bar = self.manager.counter(total=num_images, desc="Images Downloaded", position=2)
-        self.processed_bar = self.manager.counter(total=num_images, desc="Images Processed", position=3)
 
         self.download_bar.refresh()
         self.processed_bar.refresh()
 
-    def set_state(self, state: str) -> None:
+    def set_state(self, state: str, force: bool = True) -> None:
+        """
+        Sets the state shown in the status bar. States which change once per card should pass `force=False`, so the
+        status bar is redrawn at most once every `PROGRESS_REFRESH_INTERVAL` seconds rather than for every card.
+        """
+
         self.state = state
-        self.status_bar.update(state=f"{bold(self.state)}")
-        self.status_bar.refresh()
+        self.status_bar.update(state=f"{bold(self.state)}", force=force)
 
     def __attrs_post_init__(self) -> None:
         self.ask_questions()
@@ -76,81 +178,152 @@ class PdfExporter:
                 "when": lambda result: result["split_faces"] is False,
                 "transformer": lambda result: 1 if (int_result := int(result)) < 1 else int_result,
             },
+            {
+                "type": "number",
+                "name": "a3_pages_per_file",
+                "message": "How many A3 pages should be included in the generated files? Note: The more pages per "
+                + "file, the more memory the processing will use and the larger the file size will be.",
+                "default": 10,
+                "when": lambda result: result["split_faces"] is True,
+                "transformer": lambda result: 1 if (int_result := int(result)) < 1 else int_result,
+            },
         ]
         answers = InquirerPy.prompt(questions)
         if answers["split_faces"]:
             self.separate_faces = True
             self.number_of_cards_per_file = 1
+            self.number_of_a3_pages_per_file = (
+                1 if (int_a3_pages_per_file := int(answers["a3_pages_per_file"])) < 1 else int_a3_pages_per_file
+            )
         else:
             self.number_of_cards_per_file = (
                 1 if (int_cards_per_file := int(answers["cards_per_file"])) < 1 else int_cards_per_file
             )
 
     def generate_file_path(self) -> None:
-        basename = os.path.basename(str(self.order.name))
-        if not basename:
-            basename = "cards.xml"
-        file_name = os.path.splitext(basename)[0]
-        self.save_path = f"export/{file_name}/"
-        os.makedirs(self.save_path, exist_ok=True)
+        save_directory = Path("export") / (Path(self.order.name or "").stem or "cards")
+        save_directory.mkdir(parents=True, exist_ok=True)
         if self.separate_faces:
             for face in ["backs", "fronts"]:
-                os.makedirs(self.save_path + face, exist_ok=True)
+                (save_directory / face).mkdir(exist_ok=True)
+        self.save_path = f"{save_directory.as_posix()}/"
 
     def generate_pdf(self) -> None:
         pdf = FPDF("P", "in", (self.card_width_in_inches, self.card_height_in_inches))
+        self.carry_over_images(pdf)
         self.pdf = pdf
-        
+        # every image fills its page exactly, so its placement on the page never changes - only which image is drawn.
+        # this is the content stream `FPDF.image` would write for an image at (0, 0) sized to the page.
+        self.card_image_stream = (
+            f"q {self.card_width_in_inches * pdf.k:.2f} 0 0 {self.card_height_in_inches * pdf.k:.2f} 0.00 0.00 cm"
+            " /I{index} Do Q"
+        )
+
     def generate_pdf_a3(self) -> None:
-        pdf = FPDF(orientation='L', format='A3')
+        pdf = FPDF(orientation="L", format="A3")
+        self.carry_over_images(pdf)
         self.pdf = pdf
+        self.a3_cut_lines = a3_cut_lines_stream(pdf)
+
+    def carry_over_images(self, pdf: FPDF) -> None:
+        """
+        Seeds the image cache of `pdf` with the images embedded in the file currently being written, so that images
+        which appear in consecutive files (such as a shared cardback) are only read and parsed once. fpdf only
+        embeds images which are used in a file, so carried over images cost nothing in files which don't use them.
+        Only the previous file's images are carried over, so memory usage stays bounded by the size of one file.
+        """
+
+        if self.pdf is None:
+            return
+        previous_cache, cache = self.pdf.image_cache, pdf.image_cache
+        icc_profiles_by_index = {index: icc_profile for icc_profile, index in previous_cache.icc_profiles.items()}
+        for name, info in previous_cache.images.items():
+            if not isinstance(info, RasterImageInfo) or info["usages"] == 0:
+                continue
+            # image indices are allocated per document, so each carried over image is re-indexed
+            carried_info = RasterImageInfo(info, i=len(cache.images) + 1, usages=0)
+            if info["iccp_i"] is not None:
+                icc_profile = icc_profiles_by_index[info["iccp_i"]]
+                carried_info["iccp_i"] = cache.icc_profiles.setdefault(icc_profile, len(cache.icc_profiles))
+            cache.images[name] = carried_info
 
     def add_image(self, image_path: str) -> None:
+        """
+        Adds a page to the PDF showing the image at `image_path`. The image is registered with fpdf (which parses it
+        on first use and counts its usages) and drawn by writing `card_image_stream` directly, which skips the
+        sizing and positioning logic `FPDF.image` would otherwise repeat for every page.
+        """
+
         self.pdf.add_page()
-        self.pdf.image(image_path, x=0, y=0, w=self.card_width_in_inches, h=self.card_height_in_inches)
+        _, _, info = preload_image(self.pdf.image_cache, image_path)
+        if "smask" in info:  # images with transparency require a soft mask, introduced in PDF 1.4
+            self.pdf._set_min_pdf_version("1.4")
+        self.pdf._out(self.card_image_stream.format(index=info["i"]))
 
     def save_file(self) -> None:
         extra = ""
         if self.separate_faces:
             extra = f"{self.current_face}/"
-        self.pdf.output(f"{self.save_path}{self.file_num}.pdf")
-
-    def download_and_collect_images(self, post_processing_config: Optional[ImagePostProcessingConfig]) -> None:
-        with ThreadPoolExecutor(max_workers=THREADS) as pool:
-            self.order.fronts.download_images(pool, self.download_bar, post_processing_config)
-            self.order.backs.download_images(pool, self.download_bar, post_processing_config)
-
-        backs_by_slots = {}
-        for card in self.order.backs.cards:
-            for slot in card.slots:
-                backs_by_slots[slot] = card.file_path
-
-        fronts_by_slots = {}
-        for card in self.order.fronts.cards:
-            for slot in card.slots:
-                fronts_by_slots[slot] = card.file_path
-
-        paths_by_slot = {}
-        for slot in fronts_by_slots.keys():
-            paths_by_slot[slot] = (str(backs_by_slots.get(slot, backs_by_slots[0])), str(fronts_by_slots[slot]))
-        self.paths_by_slot = paths_by_slot
+        file_path = f"{self.save_path}{self.file_num}.pdf"
+        # write to a temporary file first so a partially written PDF never appears at `file_path`
+        self.pdf.output(f"{file_path}.part")
+        os.replace(f"{file_path}.part", file_path)
+
+    def download_and_collect_images(
+        self,
+        post_processing_config: Optional[ImagePostProcessingConfig],
+        preparation_pool: Optional[ProcessPoolExecutor] = None,
+    ) -> None:
+        """
+        Downloads the images for both faces of the order and collects their paths by slot. If `preparation_pool` is
+        given, each front image is submitted to it for preparation as soon as it has been downloaded, so preparation
+        overlaps with the remaining downloads. The same pool is used to post-process images, so that the two don't
+        compete for the CPU with twice as many processes as it has cores.
+        """
+
+        with ExitStack() as stack:
+            # the post-processing pool is entered first so it outlives the download threads which submit to it
+            post_processing_pool = preparation_pool or stack.enter_context(
+                ProcessPoolExecutor(max_workers=PROCESSES, mp_context=PROCESS_POOL_CONTEXT)
+            )
+            pool = stack.enter_context(ThreadPoolExecutor(max_workers=THREADS))
+            self.order.fronts.download_images(pool, self.download_bar, post_processing_config, post_processing_pool)
+            self.order.backs.download_images(pool, self.download_bar, post_processing_config, post_processing_pool)
+            if preparation_pool is not None:
+                # each card is put onto the queue exactly once, whether or not it downloaded successfully
+                for _ in range(len(self.order.fronts.cards)):
+                    card = self.order.fronts.queue.get()
+                    if card.downloaded and card.file_path is not None:
+                        self.start_preparing_image(preparation_pool, card.file_path)
+
+        backs_by_slots = {slot: card.file_path for card in self.order.backs.cards for slot in card.slots}
+        fronts_by_slots = {slot: card.file_path for card in self.order.fronts.cards for slot in card.slots}
+        # assembled in slot order once here so the export loops can iterate over it directly rather than sorting
+        default_back_path = backs_by_slots[0]
+        self.paths_by_slot = {
+            slot: (str(backs_by_slots.get(slot, default_back_path)), str(fronts_by_slots[slot]))
+            for slot in sorted(fronts_by_slots.keys())
+        }
 
     def execute(self, post_processing_config: Optional[ImagePostProcessingConfig]) -> None:
-        self.download_and_collect_images(post_processing_config=post_processing_config)
         if self.separate_faces:
             self.number_of_cards_per_file = 1
-            self.prepare_images()
+            with ProcessPoolExecutor(max_workers=PROCESSES, mp_context=PROCESS_POOL_CONTEXT) as preparation_pool:
+                self.download_and_collect_images(
+                    post_processing_config=post_processing_config, preparation_pool=preparation_pool
+                )
+                self.prepare_images(preparation_pool)
             self.export_a3()
             # self.export_separate_faces()
         else:
+            self.download_and_collect_images(post_processing_config=post_processing_config)
             self.export()
 
         print(f"Finished exporting files! They should be accessible at {self.save_path}.")
 
     def export(self) -> None:
-        for slot in sorted(self.paths_by_slot.keys()):
-            (back_path, front_path) = self.paths_by_slot[slot]
-            self.set_state(f"Working on slot {slot}")
+        for slot, (back_path, front_path) in self.paths_by_slot.items():
+            self.set_state(f"Working on slot {slot}", force=False)
             if slot == 0:
                 self.generate_pdf()
             elif slot % self.number_of_cards_per_file == 0:
@@ -158,7 +331,7 @@ class PdfExporter:
                 self.save_file()
                 self.file_num = self.file_num + 1
                 self.generate_pdf()
-            self.set_state(f"Adding images for slot {slot}")
+            self.set_state(f"Adding images for slot {slot}", force=False)
             self.add_image(back_path)
             self.add_image(front_path)
             self.processed_bar.update()
@@ -168,8 +341,7 @@ class PdfExporter:
 
     def export_separate_faces(self) -> None:
         all_faces = ["backs", "fronts"]
-        for slot in sorted(self.paths_by_slot.keys()):
-            image_paths_tuple = self.paths_by_slot[slot]
+        for slot, image_paths_tuple in self.paths_by_slot.items():
             self.set_state(f"Working on slot {slot}")
             for face in all_faces:
                 face_index = all_faces.index(face)
@@ -181,201 +353,326 @@ class PdfExporter:
                 if face_index == 1:
                     self.file_num = self.file_num + 1
     
-    def export_a3(self):
-        line_w = 0.14
-        line_lv = 297
-        line_lh = 440
-        image_w = 63
-        image_h = 88
-        top = 15
-        left = 20
-        gap = 0.5
-
+    def export_a3(self) -> None:
         # create pdf in a3 format
         self.generate_pdf_a3()
         self.add_a3_page()
 
-        i = 0        
-        # iterate over pages adding images
-        for slot in sorted(self.paths_by_slot.keys()):
-            image_paths_tuple = self.paths_by_slot[slot]
-            self.set_state(f"Working on slot {slot}")
+        # iterate over pages adding images. files are capped at `number_of_a3_pages_per_file` pages so that
+        # the images embedded in each file only need to be held in memory until that file is written.
+        cards_per_file = A3_CARDS_PER_PAGE * self.number_of_a3_pages_per_file
+        for i, (slot, (_, front_path)) in enumerate(self.paths_by_slot.items()):
+            self.set_state(f"Working on slot {slot}", force=False)
 
-            if i > 0 and i % 18 == 0:
+            if i > 0 and i % cards_per_file == 0:
+                self.set_state(f"Saving PDF #{self.file_num}")
+                self.save_file()
+                self.file_num = self.file_num + 1
+                self.generate_pdf_a3()
+                self.add_a3_page()
+            elif i > 0 and i % A3_CARDS_PER_PAGE == 0:
                 self.add_a3_page()
 
-            # calculate position relative to card index and position on a page
-            # page contains 3 rows of 6 cards
-            x = left + (i % 6) * image_w + (i % 6) * gap
-            y = top + int(i / 6 % 3) * image_h + int(i / 6 % 3) * gap
-            
-            # add image
-            self.pdf.image(
-                image_paths_tuple[1],
-                x=x,
-                y=y,
-                w=image_w,
-                h=image_h,
-            )
-            i += 1
+            x, y = A3_POSITIONS[i % A3_CARDS_PER_PAGE]
+            self.pdf.image(front_path, x=x, y=y, w=CARD_WIDTH_MM, h=CARD_HEIGHT_MM)
         # done adding pages and images
+        self.set_state(f"Saving PDF #{self.file_num}")
         self.save_file()
 
-    def add_a3_page(self):
-        
-        line_w = 0.14
-        line_lv = 297
-        line_lh = 440
-        image_w = 63
-        image_h = 88
-        top = 15
-        left = 20
-        gap = 0.5
-
-
+    def add_a3_page(self) -> None:
         self.pdf.add_page()
-        # add page, add lines
-        # DRAW SIDE CUT LINES
-        # left
-        self.pdf.dashed_line(left - line_w, 0, left - line_w, line_lv, 1, 2)
-        # right
-        self.pdf.dashed_line(
-            left + (image_w * 6) + gap * 5 + 0.1,
-            0,
-            left + (image_w * 6) + gap * 5 + 0.1,
-            line_lv,
-            1,
-            2,
-        )
-        # top
-        self.pdf.dashed_line(0, top - line_w, line_lh, top - line_w, 1, 2)
-        # bottom
-        self.pdf.dashed_line(
-            0,
-            top + image_h * 3 + gap * 2 + 0.1,
-            line_lh,
-            top + image_h * 3 + gap * 2 + 0.1,
-            1,
-            2,
-        )
-    
-        # draw vertical lines between cards
-        for i in range(1, 6):
-            # draw 2 lines for easier cutting
-            self.pdf.dashed_line(
-                left + image_w * i + gap * (i-1) + 0.1,
-                0,
-                left + image_w * i + gap * (i-1) + 0.1,
-                line_lv,
-                1,
-                2,
-            )
-            self.pdf.dashed_line(
-                left + image_w * i + gap * (i-1) + gap - line_w,
-                0,
-                left + image_w * i + gap * (i-1) + gap - line_w,
-                line_lv,
-                1,
-                2,
-            )
-    
-        # draw horizontal lines between cards
-        for i in range(1, 3):
-            # draw 2 lines for easier cutting
-            self.pdf.dashed_line(
-                0, top + image_h * i + gap * (i-1) + 0.1, line_lh, top + image_h * i + gap * (i-1) + 0.1, 1, 2
-            )
-            self.pdf.dashed_line(
-                0,
-                top + image_h * i + gap * (i-1) + gap - line_w,
-                line_lh,
-                top + image_h * i + gap * (i-1) + gap - line_w,
-                1,
-                2,
-            )
-    # end add_a3_page
-                    
-    def prepare_images(self) -> None:
-        print('preparing images')
-        for slot in self.paths_by_slot.keys():
-            front_back_image_tuple = self.paths_by_slot[slot]
-            # convert image to jpg if it's not
-            jpeg_path = self.convert_to_jpg(front_back_image_tuple[1])
-            # re-set image back into paths
-            self.paths_by_slot[slot] = (front_back_image_tuple[0], jpeg_path)
-            
-            need_downsize = 0
-            need_reshape = 1
-            need_compression = 2
-            preparadness_check_result = self.images_havent_been_prepared(jpeg_path)
-            if (preparadness_check_result[need_compression]):
-                # compress before downsizing - it will preserve better quality
-                # compress image to reduce it's size
-                self.compress_image(jpeg_path)
-            if (preparadness_check_result[need_reshape]):
-                # cut sides of the image to reduce border size
-                self.cut_and_reshape(jpeg_path)
-            if (preparadness_check_result[need_downsize]):
-                # resize image to reduce it's size
-                self.downsize_image(jpeg_path)
-
-# convert image to jpg -- update the image name (stored)
-    def convert_to_jpg(self, image_path: str) -> None:
-        if image_path.endswith('jpg'):
-            return image_path
-        jpeg_path = self.new_jpg_path(image_path)
-        if os.path.exists(jpeg_path): # if jpg was previously processed and exists, skip ceation of jpg
-            return jpeg_path
-        print('converting to jpg')
-        command = f'magick "{image_path}" "{jpeg_path}"'
-        subprocess.run(command, shell=True, capture_output=False, text=False)
+        self.pdf._out(self.a3_cut_lines)
+
+    def start_preparing_image(self, pool: ProcessPoolExecutor, image_path: str) -> None:
+        """
+        Submits the image at `image_path` to `pool` for preparation, unless it has already been submitted or was
+        prepared by a previous export.
+        """
+
+        # many slots commonly share the same image - each distinct file is prepared once, and every slot is remapped
+        # to it afterwards. this also means no two workers ever write to the same file.
+        source_path = os.path.realpath(image_path)
+        if source_path in self.prepared_paths or source_path in self.preparing_paths:
+            return
+        if is_prepared(source_path):
+            # prepared by a previous export - no need to open the image at all
+            self.prepared_paths[source_path] = new_jpg_path(source_path)
+            self.processed_bar.update()
+        else:
+            self.preparing[pool.submit(prepare_image, source_path)] = source_path
+            self.preparing_paths.add(source_path)
+
+    def prepare_images(self, pool: ProcessPoolExecutor) -> None:
+        """
+        Converts and reshapes the front image of each slot ahead of A3 layout. Each image is prepared independently,
+        so the work is spread across `pool`. Images already submitted while downloading are not submitted again.
+        """
+
+        self.set_state("Preparing images")
+        for _, front_path in self.paths_by_slot.values():
+            self.start_preparing_image(pool, front_path)
+        for future in as_completed(self.preparing):
+            self.prepared_paths[self.preparing[future]] = future.result()
+            self.processed_bar.update()
+        self.preparing.clear()
+        self.preparing_paths.clear()
+
+        # as each prepared image has exactly one path, fpdf embeds it in the output once however many slots use it
+        self.paths_by_slot = {
+            slot: (back_path, self.prepared_paths[os.path.realpath(front_path)])
+            for slot, (back_path, front_path) in self.paths_by_slot.items()
+        }
+
+
+# region image preparation
+# these are module-level so they can be pickled and run in a process pool
+
+SHAVE_RATIO = 0.028  # proportion of each edge trimmed off to reduce the size of the border
+JPEG_QUALITY = 85
+GRAYSCALE_TOLERANCE = 8  # maximum difference between colour channels for a pixel to be considered grey
+GRAYSCALE_TINT_TOLERANCE = 1  # maximum difference between the average levels of colour channels in a grey image
+JPEGTRAN = shutil.which("jpegtran")
+# jpegtran crops from a block boundary - 16 pixels covers the largest blocks, used by chroma subsampled images
+JPEG_CROP_ALIGNMENT = 16
+# SOF0 to SOF15, excluding DHT (0xC4), JPG (0xC8) and DAC (0xCC) which share the range
+JPEG_START_OF_FRAME_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def prepare_image(image_path: str) -> str:
+    """
+    Prepares the image at `image_path` for A3 layout and returns the path of the prepared JPEG.
+    The image is decoded once, trimmed to the card's aspect ratio if required, and encoded once. Existing JPEGs which
+    only need trimming are cropped losslessly with jpegtran where it's available, so they aren't decoded at all.
+    """
+
+    jpeg_path = new_jpg_path(image_path)
+    # if jpg was previously processed and exists, work from it rather than the original image - unless the original
+    # has been replaced since, in which case the jpg holds stale artwork and is rebuilt
+    source_path = image_path
+    if os.path.exists(jpeg_path) and os.stat(jpeg_path).st_mtime_ns >= os.stat(image_path).st_mtime_ns:
+        source_path = jpeg_path
+    if source_path == jpeg_path and (size := jpeg_size(jpeg_path)) is not None and has_card_aspect_ratio(*size):
+        mark_as_prepared(image_path)
         return jpeg_path
-
-    def new_jpg_path(self, image_path) -> None:
-        last_dot_index = image_path.rfind(".")
-        return image_path[:last_dot_index] + ".jpg"
-
-    def compress_image(self, jpeg_path: str) -> None:
-        print('compressing image')
-        command = f'magick "{jpeg_path}" -strip -interlace Plane -gaussian-blur 0.05 -quality 85% "{jpeg_path}"'
-        subprocess.run(command, shell=True, capture_output=False, text=False)
-
-    def downsize_image(self, jpeg_path: str) -> None:
-        print('resizint image')
-        command = f'mogrify -resize "60%" "{jpeg_path}"'
-        subprocess.run(command, shell=True, capture_output=False, text=False)
-       
-    def cut_and_reshape(self, jpeg_path: str) -> None:
-        print('cutting corners')
-        command = f'mogrify -shave "2.8%x2.8%" -gravity center -crop "63:88" "{jpeg_path}"'
-        subprocess.run(command, shell=True, capture_output=False, text=False)
-
-    def images_havent_been_prepared(self, jpeg_path):
-        command = f'identify -verbose "{jpeg_path}"'
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        output = str(result.stdout)
-        # print(output)
-        # if amount of pixels is too large - crop and downsize
-        output = output.splitlines()
-        need_downsize = False
-        need_reshape = True
-        need_compression = False
-        for line in output:
-            if "Geometry" in line:
-                w, h = line.strip().split(" ")[1].split("+")[0].split("x")
-                w = int(w)
-                h = int(h)
-                # check size is lower than large x and y - if not, downsize by certain percentage - calculate the percentage
-                # if w < 1020 and h < 1500:
-                #     need_downsize = False
-                # check shape is of certain relationship to each other, if not - need reshape
-                w_rel = round(w/63, 1)
-                h_rel = round(h/88, 1)
-                if w_rel == h_rel: 
-                    need_reshape = False
-            # elif "Quality: " in line:
-            #     # check compression
-            #     quality = int(line.strip().split(" ")[1])
-            #     if quality <= 85:
-            #         need_compression = False
-        return [need_downsize, need_reshape, need_compression]
+    with Image.open(source_path) as img:
+        need_reshape = not has_card_aspect_ratio(*img.size)
+        crop_box = card_crop_box(*img.size)
+        is_existing_jpeg = source_path == jpeg_path and img.format == "JPEG"
+        prepared, icc_profile = (None, None) if is_existing_jpeg else convert_to_rgb(img)
+    if prepared is None:
+        if not need_reshape or crop_jpeg_losslessly(jpeg_path, crop_box):
+            mark_as_prepared(image_path)
+            return jpeg_path
+        with Image.open(jpeg_path) as img:
+            prepared, icc_profile = convert_to_rgb(img)
+    if need_reshape:
+        prepared = prepared.crop(crop_box)
+    colour_space = icc_colour_space(icc_profile)
+    if colour_space in (None, "GRAY") and is_grayscale(prepared):
+        # a single channel takes roughly a third of the space, and fpdf embeds it as DeviceGray.
+        # images with an RGB profile are left as they are, as their profile can't describe a single channel
+        prepared = prepared.convert("L")
+    if colour_space != {"RGB": "RGB", "L": "GRAY"}[prepared.mode]:
+        icc_profile = None  # a profile which doesn't match the image's channels would make the PDF invalid
+    prepared.save(
+        jpeg_path,
+        "JPEG",
+        quality=JPEG_QUALITY,
+        optimize=True,
+        progressive=True,
+        subsampling="4:2:0",
+        icc_profile=icc_profile,
+    )
+    mark_as_prepared(image_path)
+    return jpeg_path
+
+
+def convert_to_rgb(img: Image.Image) -> tuple[Image.Image, Optional[bytes]]:
+    """
+    Converts `img` to RGB, returning it along with the ICC profile describing its colours. CMYK images with a profile
+    are converted to sRGB through their profile, rather than with Pillow's naive conversion.
+    """
+
+    icc_profile = img.info.get("icc_profile")
+    if img.mode == "CMYK" and icc_colour_space(icc_profile) == "CMYK":
+        srgb_profile = ImageCms.createProfile("sRGB")
+        converted = ImageCms.profileToProfile(
+            img, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)), srgb_profile, outputMode="RGB"
+        )
+        return converted, ImageCms.ImageCmsProfile(srgb_profile).tobytes()
+    return img.convert("RGB"), icc_profile
+
+
+def icc_colour_space(icc_profile: Optional[bytes]) -> Optional[str]:
+    """
+    The colour space described by `icc_profile`, such as "RGB", "GRAY" or "CMYK", or None if there's no valid profile.
+    """
+
+    if not icc_profile:
+        return None
+    try:
+        return ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)).profile.xcolor_space.strip()
+    except OSError:
+        return None
+
+
+def new_jpg_path(image_path: str) -> str:
+    return os.path.splitext(image_path)[0] + ".jpg"
+
+
+def preparation_key(image_path: str) -> str:
+    """
+    Identifies the current versions of both `image_path` and its prepared JPEG, such that replacing either file
+    invalidates the marker left by `mark_as_prepared`.
+    """
+
+    jpeg_path = new_jpg_path(image_path)
+    key = f"{image_path}:{os.stat(image_path).st_mtime_ns}:{os.stat(jpeg_path).st_mtime_ns}"
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def marker_path(image_path: str) -> str:
+    return new_jpg_path(image_path) + ".prepared"
+
+
+def mark_as_prepared(image_path: str) -> None:
+    with open(marker_path(image_path), "w") as f:
+        f.write(preparation_key(image_path))
+
+
+def is_prepared(image_path: str) -> bool:
+    try:
+        with open(marker_path(image_path)) as f:
+            return f.read() == preparation_key(image_path)
+    except OSError:
+        return False
+
+
+def jpeg_size(jpeg_path: str) -> Optional[tuple[int, int]]:
+    """
+    Reads the width and height of the JPEG at `jpeg_path` from its start of frame marker, which sits in the first
+    few hundred bytes of the file, without handing the file to Pillow.
+    Returns None if the file isn't a JPEG or its frame header can't be found.
+    """
+
+    with open(jpeg_path, "rb") as f:
+        if f.read(2) != b"\xff\xd8":  # start of image
+            return None
+        while True:
+            if f.read(1) != b"\xff":
+                return None
+            marker = f.read(1)
+            while marker == b"\xff":  # markers may be preceded by any number of fill bytes
+                marker = f.read(1)
+            if not marker or marker[0] == 0xDA:  # start of scan - compressed data follows, so no frame header exists
+                return None
+            if 0xD0 <= marker[0] <= 0xD8 or marker[0] == 0x01:  # standalone markers have no segment
+                continue
+            segment_length = f.read(2)
+            if len(segment_length) < 2:
+                return None
+            if marker[0] in JPEG_START_OF_FRAME_MARKERS:
+                # the segment continues with the sample precision (1 byte), height (2 bytes) and width (2 bytes)
+                frame_header = f.read(5)
+                if len(frame_header) < 5:
+                    return None
+                return int.from_bytes(frame_header[3:5], "big"), int.from_bytes(frame_header[1:3], "big")
+            f.seek(int.from_bytes(segment_length, "big") - 2, os.SEEK_CUR)
+
+
+def has_card_aspect_ratio(width: int, height: int) -> bool:
+    # within a pixel of the card's exact width for this height, which is as close as a whole number of pixels can be
+    return abs(width * CARD_HEIGHT_MM - height * CARD_WIDTH_MM) <= CARD_HEIGHT_MM
+
+
+def is_grayscale(img: Image.Image) -> bool:
+    """
+    Whether every pixel of the RGB image `img` has near-equal red, green and blue values - allowing for the small
+    differences introduced by JPEG compression of a greyscale source. Those differences average out across the image,
+    so an image whose channels are consistently offset from one another, such as a faint sepia, is not grey.
+    """
+
+    red, green, blue = img.split()
+    if any(
+        ImageChops.difference(a, b).getextrema()[1] > GRAYSCALE_TOLERANCE
+        for a, b in ((red, green), (green, blue), (red, blue))
+    ):
+        return False
+    channel_means = ImageStat.Stat(img).mean
+    return max(channel_means) - min(channel_means) <= GRAYSCALE_TINT_TOLERANCE
+
+
+def card_crop_box(width: int, height: int) -> tuple[int, int, int, int]:
+    """
+    The box which trims `SHAVE_RATIO` off each edge of a `width` x `height` image, then crops the remainder about its
+    centre to the card's aspect ratio.
+    """
+
+    left, top = round(width * SHAVE_RATIO), round(height * SHAVE_RATIO)
+    right, bottom = width - left, height - top
+    inner_width, inner_height = right - left, bottom - top
+    if inner_width * CARD_HEIGHT_MM > inner_height * CARD_WIDTH_MM:
+        excess = inner_width - round(inner_height * CARD_WIDTH_MM / CARD_HEIGHT_MM)
+        left, right = left + excess // 2, right - (excess - excess // 2)
+    else:
+        excess = inner_height - round(inner_width * CARD_HEIGHT_MM / CARD_WIDTH_MM)
+        top, bottom = top + excess // 2, bottom - (excess - excess // 2)
+    return left, top, right, bottom
+
+
+def block_aligned_crop_box(crop_box: tuple[int, int, int, int]) -> tuple[int, int, int, int]:
+    """
+    Shrinks `crop_box` so that its top left corner lies on the JPEG block grid, which jpegtran requires in order to
+    crop losslessly, and its bottom right corner is moved in to keep the card's aspect ratio.
+    """
+
+    left, top, right, bottom = crop_box
+    # rounded up rather than down, so that no bleed outside of the original box is kept
+    left = -(-left // JPEG_CROP_ALIGNMENT) * JPEG_CROP_ALIGNMENT
+    top = -(-top // JPEG_CROP_ALIGNMENT) * JPEG_CROP_ALIGNMENT
+    width, height = right - left, bottom - top
+    if width * CARD_HEIGHT_MM > height * CARD_WIDTH_MM:
+        width = round(height * CARD_WIDTH_MM / CARD_HEIGHT_MM)
+    else:
+        height = round(width * CARD_HEIGHT_MM / CARD_WIDTH_MM)
+    return left, top, left + width, top + height
+
+
+def crop_jpeg_losslessly(jpeg_path: str, crop_box: tuple[int, int, int, int]) -> bool:
+    """
+    Crops the JPEG at `jpeg_path` in place to within `crop_box` with jpegtran, which works on the compressed data
+    directly rather than decoding and re-encoding the image. jpegtran can only crop from a block boundary, so the box is
+    first shrunk onto the block grid by `block_aligned_crop_box`, trimming up to 15 pixels more off the top and left.
+    The image's colour profile is kept, and any other metadata is dropped.
+    Returns whether the crop was successful - if jpegtran is not installed, fails, or doesn't produce an image with the
+    card's aspect ratio, the file is left untouched.
+    """
+
+    if JPEGTRAN is None:
+        return False
+    left, top, right, bottom = block_aligned_crop_box(crop_box)
+    temporary_path = f"{jpeg_path}.part"
+    result = subprocess.run(
+        [
+            JPEGTRAN,
+            "-crop",
+            f"{right - left}x{bottom - top}+{left}+{top}",
+            "-copy",
+            "icc",  # versions of jpegtran without this option fail, and the image is cropped with Pillow instead
+            "-optimize",
+            "-progressive",
+            "-outfile",
+            temporary_path,
+            jpeg_path,
+        ],
+        capture_output=True,
+    )
+    if result.returncode != 0 or (size := jpeg_size(temporary_path)) is None or not has_card_aspect_ratio(*size):
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        return False
+    os.replace(temporary_path, jpeg_path)
+    return True
+
+
+# endregion
@@ -24,3 +24,11 @@ def post_process_image(raw_image: bytes, config: ImagePostProcessingConfig) -> I
         img = img.resize((new_width, new_height), config.downscale_alg.value)
 
     return img
+
+
+def post_process_and_save_image(raw_image: bytes, config: ImagePostProcessingConfig, file_path: str) -> None:
+    """
+    Post-processes `raw_image` and saves the result to `file_path`. Module-level so it can be run in a process pool.
+    """
+
+    post_process_image(raw_image=raw_image, config=config).save(file_path)
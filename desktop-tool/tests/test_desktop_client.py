@@ -1,13 +1,17 @@
+import base64
 import os
+import shutil
 import textwrap
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from queue import Queue
 from typing import Generator
 from xml.etree import ElementTree
 
 import pytest
 from enlighten import Counter
+from PIL import Image, ImageCms
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
@@ -15,9 +19,24 @@ from selenium.webdriver.support.wait import WebDriverWait
 import src.constants as constants
 import src.utils
 from src.driver import AutofillDriver
-from src.io import get_google_drive_file_name, remove_directories, remove_files
+from src.io import (
+    download_google_drive_file,
+    get_google_drive_file_name,
+    remove_directories,
+    remove_files,
+)
 from src.order import CardImage, CardImageCollection, CardOrder, Details
-from src.pdf_maker import PdfExporter
+from src.pdf_maker import (
+    GRAYSCALE_TOLERANCE,
+    JPEG_CROP_ALIGNMENT,
+    JPEGTRAN,
+    PdfExporter,
+    block_aligned_crop_box,
+    card_crop_box,
+    has_card_aspect_ratio,
+    jpeg_size,
+    prepare_image,
+)
 from src.processing import ImagePostProcessingConfig
 from src.utils import text_to_list
 
@@ -548,6 +567,24 @@ def test_download_google_drive_image_no_post_processing(
     assert_file_size(image_valid_google_drive.file_path, 155686)
 
 
+def test_download_google_drive_file_broken_post_processing_pool(monkeypatch, tmp_path):
+    with open(f"{FILE_PATH}/cards/{TEST_IMAGE}.png", "rb") as f:
+        response = base64.b64encode(f.read()).decode()
+    monkeypatch.setattr("src.io.safe_get_api_call", lambda **_: response)
+    file_path = str(tmp_path / f"{TEST_IMAGE}.png")
+    with ProcessPoolExecutor(max_workers=1, mp_context=constants.PROCESS_POOL_CONTEXT) as post_processing_pool:
+        # a worker which crashes breaks the pool for every later submission
+        with pytest.raises(BrokenProcessPool):
+            post_processing_pool.submit(os._exit, 1).result()
+        assert download_google_drive_file(
+            drive_id=TEST_IMAGE,
+            file_path=file_path,
+            post_processing_config=DEFAULT_POST_PROCESSING,
+            post_processing_pool=post_processing_pool,
+        )
+    assert os.path.exists(file_path)
+
+
 def test_invalid_google_drive_image(image_invalid_google_drive: CardImage, counter: Counter, queue: Queue[CardImage]):
     image_invalid_google_drive.download_image(
         download_bar=counter, queue=queue, post_processing_config=DEFAULT_POST_PROCESSING
@@ -852,6 +889,187 @@ def test_pdf_export_complete_separate_faces(monkeypatch, card_order_valid):
     remove_directories(["export/test_order/backs", "export/test_order/fronts", "export/test_order", "export"])
 
 
+@pytest.mark.parametrize("save_kwargs", [{}, {"progressive": True}, {"exif": Image.Exif()}])
+def test_jpeg_size(tmp_path, save_kwargs):
+    jpeg_path = str(tmp_path / f"{TEST_IMAGE}.jpg")
+    with Image.open(f"{FILE_PATH}/cards/{TEST_IMAGE}.png") as img:
+        img.convert("RGB").save(jpeg_path, "JPEG", **save_kwargs)
+        assert jpeg_size(jpeg_path) == img.size
+
+
+def test_jpeg_size_not_a_jpeg():
+    assert jpeg_size(f"{FILE_PATH}/cards/{TEST_IMAGE}.png") is None
+
+
+@pytest.mark.parametrize("width, height", [(600, 900), (745, 1040), (827, 1122), (1500, 2000), (2176, 2960)])
+def test_block_aligned_crop_box(width, height):
+    crop_box = card_crop_box(width, height)
+    left, top, right, bottom = block_aligned_crop_box(crop_box)
+    assert left % JPEG_CROP_ALIGNMENT == 0 and top % JPEG_CROP_ALIGNMENT == 0
+    assert crop_box[0] <= left < right <= crop_box[2] and crop_box[1] <= top < bottom <= crop_box[3]
+    assert has_card_aspect_ratio(right - left, bottom - top)
+
+
+@pytest.mark.parametrize(
+    "jpegtran",
+    [
+        pytest.param(JPEGTRAN, marks=pytest.mark.skipif(JPEGTRAN is None, reason="jpegtran is not installed")),
+        None,
+    ],
+)
+def test_prepare_image_crops_jpeg_to_card_aspect_ratio(monkeypatch, tmp_path, jpegtran):
+    monkeypatch.setattr("src.pdf_maker.JPEGTRAN", jpegtran)
+    jpeg_path = str(tmp_path / f"{TEST_IMAGE}.jpg")
+    with Image.open(f"{FILE_PATH}/cards/{TEST_IMAGE}.png") as img:
+        assert not has_card_aspect_ratio(*img.size)
+        img.convert("RGB").save(jpeg_path, "JPEG")
+
+    assert prepare_image(jpeg_path) == jpeg_path
+    assert has_card_aspect_ratio(*jpeg_size(jpeg_path))
+
+
+def test_pdf_export_a3_rebuilds_replaced_images(monkeypatch, tmp_path, card_order_valid):
+    def do_nothing(_):
+        return None
+
+    def prepare(source_path: str) -> str:
+        pdf_exporter = PdfExporter(order=card_order_valid)
+        pdf_exporter.paths_by_slot = {0: (source_path, source_path)}
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pdf_exporter.prepare_images(pool)
+        return pdf_exporter.paths_by_slot[0][1]
+
+    monkeypatch.setattr("src.pdf_maker.PdfExporter.ask_questions", do_nothing)
+    card_order_valid.name = "test_order.xml"
+    image_path = str(tmp_path / "card.png")
+    shutil.copy(f"{FILE_PATH}/cards/{TEST_IMAGE}.png", image_path)
+    prepared_path = prepare(image_path)
+
+    # replace the source image, as re-downloading it would, with one of a different size
+    shutil.copy(f"{FILE_PATH}/cards/Simple Lotus.png", image_path)
+    jpeg_mtime_ns = os.stat(prepared_path).st_mtime_ns
+    os.utime(image_path, ns=(jpeg_mtime_ns + 1, jpeg_mtime_ns + 1))
+    assert prepare(image_path) == prepared_path
+
+    left, top, right, bottom = card_crop_box(827, 1122)
+    assert jpeg_size(prepared_path) == (right - left, bottom - top)
+    remove_directories(["export/test_order", "export"])
+
+
+def test_pdf_export_a3_splits_files(monkeypatch, tmp_path, card_order_valid):
+    def do_nothing(_):
+        return None
+
+    monkeypatch.setattr("src.pdf_maker.PdfExporter.ask_questions", do_nothing)
+    image_path = str(tmp_path / f"{TEST_IMAGE}.png")
+    shutil.copy(f"{FILE_PATH}/cards/{TEST_IMAGE}.png", image_path)
+    prepared_path = prepare_image(image_path)
+
+    card_order_valid.name = "test_order.xml"
+    pdf_exporter = PdfExporter(order=card_order_valid, number_of_a3_pages_per_file=1)
+    # one more card than fits on a single A3 page
+    pdf_exporter.paths_by_slot = {slot: (prepared_path, prepared_path) for slot in range(19)}
+    pdf_exporter.export_a3()
+
+    assert os.path.exists("export/test_order/1.pdf") and os.path.exists("export/test_order/2.pdf")
+    assert not os.path.exists("export/test_order/3.pdf")
+    assert not any(file_name.endswith(".part") for file_name in os.listdir("export/test_order"))
+    remove_files(["export/test_order/1.pdf", "export/test_order/2.pdf"])
+    remove_directories(["export/test_order", "export"])
+
+
+def test_pdf_export_carries_shared_images_over_between_files(monkeypatch, tmp_path, card_order_valid):
+    def do_nothing(_):
+        return None
+
+    monkeypatch.setattr("src.pdf_maker.PdfExporter.ask_questions", do_nothing)
+    # none of the test cards have an ICC profile, so the shared back is given one to check it's carried over too
+    back_path = str(tmp_path / "back.jpg")
+    icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    front_paths = [str(tmp_path / f"{TEST_IMAGE}.jpg"), str(tmp_path / "Simple Lotus.jpg")]
+    with Image.open(f"{FILE_PATH}/cards/{TEST_IMAGE}.png") as img:
+        img.convert("RGB").save(back_path, "JPEG", icc_profile=icc_profile)
+        img.convert("RGB").save(front_paths[0], "JPEG")
+    with Image.open(f"{FILE_PATH}/cards/Simple Lotus.png") as img:
+        img.convert("RGB").save(front_paths[1], "JPEG")
+    image_bytes = {}
+    for image_path in [back_path, *front_paths]:
+        with open(image_path, "rb") as f:
+            image_bytes[image_path] = f.read()
+
+    card_order_valid.name = "test_order.xml"
+    pdf_exporter = PdfExporter(order=card_order_valid, number_of_cards_per_file=1)
+    pdf_exporter.paths_by_slot = {slot: (back_path, front_path) for slot, front_path in enumerate(front_paths)}
+    pdf_exporter.export()
+
+    expected_generated_files = ["export/test_order/1.pdf", "export/test_order/2.pdf"]
+    for file_path, front_path in zip(expected_generated_files, front_paths):
+        with open(file_path, "rb") as f:
+            pdf_bytes = f.read()
+        # each file embeds its own images exactly once, with the back's ICC profile, and nothing from other files
+        assert pdf_bytes.count(image_bytes[back_path]) == 1
+        assert pdf_bytes.count(b"/ICCBased") == 1
+        for image_path in front_paths:
+            assert pdf_bytes.count(image_bytes[image_path]) == (image_path == front_path)
+    remove_files(expected_generated_files)
+    remove_directories(["export/test_order", "export"])
+
+
+def test_prepare_image_keeps_icc_profile(tmp_path):
+    image_path = str(tmp_path / f"{TEST_IMAGE}.png")
+    icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    with Image.open(f"{FILE_PATH}/cards/{TEST_IMAGE}.png") as img:
+        img.save(image_path, icc_profile=icc_profile)
+
+    with Image.open(prepare_image(image_path)) as prepared:
+        assert prepared.info.get("icc_profile") == icc_profile
+
+
+def test_prepare_image_grayscale(tmp_path):
+    image_path = str(tmp_path / f"{TEST_IMAGE}.png")
+    with Image.open(f"{FILE_PATH}/cards/{TEST_IMAGE}.png") as img:
+        img.convert("L").convert("RGB").save(image_path)
+
+    with Image.open(prepare_image(image_path)) as prepared:
+        assert prepared.mode == "L"
+
+
+def test_prepare_image_faint_tint_is_not_grayscale(tmp_path):
+    image_path = str(tmp_path / f"{TEST_IMAGE}.png")
+    with Image.open(f"{FILE_PATH}/cards/{TEST_IMAGE}.png") as img:
+        gray = img.convert("L")
+    # a faint sepia - no two channels of any pixel differ by more than GRAYSCALE_TOLERANCE
+    offset = GRAYSCALE_TOLERANCE // 2
+    red, blue = gray.point(lambda level: min(level + offset, 255)), gray.point(lambda level: max(level - offset, 0))
+    Image.merge("RGB", (red, gray, blue)).save(image_path)
+
+    with Image.open(prepare_image(image_path)) as prepared:
+        assert prepared.mode == "RGB"
+
+
+def test_pdf_export_a3_embeds_prepared_jpeg_verbatim(monkeypatch, tmp_path, card_order_valid):
+    def do_nothing(_):
+        return None
+
+    monkeypatch.setattr("src.pdf_maker.PdfExporter.ask_questions", do_nothing)
+    image_path = str(tmp_path / f"{TEST_IMAGE}.png")
+    shutil.copy(f"{FILE_PATH}/cards/{TEST_IMAGE}.png", image_path)
+    prepared_path = prepare_image(image_path)
+    with open(prepared_path, "rb") as f:
+        prepared_bytes = f.read()
+
+    card_order_valid.name = "test_order.xml"
+    pdf_exporter = PdfExporter(order=card_order_valid)
+    pdf_exporter.paths_by_slot = {slot: (prepared_path, prepared_path) for slot in range(3)}
+    pdf_exporter.export_a3()
+
+    # the prepared JPEG should be passed through without being re-encoded, and only embedded once across slots
+    with open("export/test_order/1.pdf", "rb") as f:
+        assert f.read().count(prepared_bytes) == 1
+    remove_files(["export/test_order/1.pdf"])
+    remove_directories(["export/test_order", "export"])
+
+
 # endregion
 
 # region test driver.py